@@ -1,18 +1,33 @@
 import torch.nn as nn
 import torch
 import numpy as np
-from torch.autograd import Variable
+from collections import OrderedDict
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+
+# block types, used to dispatch layers in Darknet.forward
+KIND_CONV = 0
+KIND_UPSAMPLE = 1
+KIND_SHORTCUT = 2
+KIND_ROUTE = 3
+KIND_YOLO = 4
+BLOCK_KINDS = {
+    'convolutional': KIND_CONV,
+    'upsample': KIND_UPSAMPLE,
+    'shortcut': KIND_SHORTCUT,
+    'route': KIND_ROUTE,
+    'yolo': KIND_YOLO,
+}
 
 # parse the cfg file to blocks
 def parse_cfg(cfg):
-
     blocks = []
     with open(cfg) as f:
-        lines = f.read().split('\n')
-    lines = [l.strip() for l in lines]
-    lines = [l for l in lines if len(l) > 0 and l[0] != '#']
+        lines = f.read().splitlines()
     block = {}
     for line in lines:
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#':
+            continue
         if line[0] == '[':
             if len(block) != 0:
                 blocks.append(block)
@@ -27,69 +42,75 @@ def parse_cfg(cfg):
 
     return blocks
 
-# Add short cut from previou layer output
+# Add short cut from previou layer output. Only holds the layer index, Darknet.forward does the addition
 class ShortcutLayer(nn.Module):
     def __init__(self, idx):
         super(ShortcutLayer, self).__init__()
         self.idx = idx
 
-    def forward(self, x, outputs):
-        return x + outputs[self.idx]
-
 class RouteLayer(nn.Module):
     def __init__(self, indices):
         super(RouteLayer, self).__init__()
         self.indices = indices
 
     def forward(self, outputs):
+        if len(self.indices) == 1:
+            return outputs[self.indices[0]]
         out = [outputs[i] for i in self.indices]
         out = torch.cat(out, dim=1)
         return out
 
 # Transform conv output to bounding boxes of [center_x, center_y, width, height, objectness score, class scores...]
 class DetectionLayer(nn.Module):
-    def __init__(self, anchors, num_classes, input_dim):
+    def __init__(self, anchors, num_classes, input_dim, grid_size):
         super(DetectionLayer, self).__init__()
-        self.anchors = torch.tensor(anchors, dtype=torch.float)
         self.num_classes = num_classes
         self.num_anchors = len(anchors)
         self.input_dim = input_dim
+        # [height, width] of the grid at the cfg input size. Forward reads the actual size from its input,
+        # except while tracing for export, where these fixed shapes keep the graph free of shape arithmetic
+        self.grid_size = grid_size
+
+        # grid offsets for the cfg input size and anchors are computed once.
+        # Buffers follow the module to the right device on .cuda()
+        self.register_buffer('grid', self.make_grid(grid_size[0], grid_size[1], input_dim // grid_size[1]), persistent=False)
+        # anchors are shaped to broadcast over [batch, anchors, 2, grid, grid]
+        self.register_buffer('anchors', torch.tensor(anchors, dtype=torch.float).view(1, self.num_anchors, 2, 1, 1), persistent=False)
+
+    # x and y offsets stacked to broadcast over the box centers and prescaled to the original image dimention
+    @staticmethod
+    def make_grid(grid_h, grid_w, stride, device=None):
+        grid_x = torch.arange(grid_w, dtype=torch.float, device=device).repeat(grid_h, 1)
+        grid_y = torch.arange(grid_h, dtype=torch.float, device=device).unsqueeze(1).repeat(1, grid_w)
+        return torch.stack((grid_x, grid_y)) * stride
+
+    def forward(self, x):
+        if torch.jit.is_tracing():
+            # batch stays dynamic in the exported graph
+            batch_size, (grid_h, grid_w) = -1, self.grid_size
+        else:
+            batch_size, grid_h, grid_w = x.size(0), x.size(2), x.size(3)
+        stride = self.input_dim // grid_w
+        if (grid_h, grid_w) == tuple(self.grid_size):
+            grid = self.grid
+        else:
+            grid = self.make_grid(grid_h, grid_w, stride, x.device)
 
-    def forward(self, x, cuda):
-        batch_size = x.size(0)
-        grid_size = x.size(2)
-        stride = self.input_dim // grid_size
-
-        detection = x.view(batch_size, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
-        # box centers
-        detection[:, :, :2, :, :] = torch.sigmoid(detection[:, :, :2, :, :])
-        # objectness score and class scores
-        detection[:, :, 4:, :, :] = torch.sigmoid(detection[:, :, 4:, :, :])
-
-        # add offset to box centers
-
-        x_offset, y_offset = np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing='xy')
-        x_offset = torch.from_numpy(x_offset).float()
-        y_offset = torch.from_numpy(y_offset).float()
-
-        if cuda:
-            x_offset = x_offset.cuda()
-            y_offset = y_offset.cuda()
-
-        x_offset = x_offset.expand_as(detection[:, :, 0, :, :])
-        y_offset = y_offset.expand_as(detection[:, :, 1, :, :])
-        detection[:, :, 0, :, :] += x_offset
-        detection[:, :, 1, :, :] += y_offset
-        # rescale to original image dimention
-        detection[:, :, :2, :, :] *= stride
+        # keep box decoding in full precision when the backbone runs under autocast
+        detection = x.float().view(batch_size, self.num_anchors, self.num_classes + 5, grid_h, grid_w)
+        # split into box centers, box width and height, objectness score and class scores. Kept functional
+        # (no in-place writes on views) so torch.compile can fuse the elementwise ops into one kernel
+        xy, wh, scores = torch.split(detection, [2, 2, self.num_classes + 1], dim=2)
 
+        # add offset to box centers and rescale to original image dimention: grid + stride * sigmoid(xy) in one op
+        xy = torch.add(grid, torch.sigmoid(xy), alpha=stride)
         # box width and height
-        anchors = self.anchors.unsqueeze(-1).unsqueeze(-1).expand_as(detection[:, :, 2:4, :, :])
-        if cuda:
-            anchors = anchors.cuda()
+        wh = torch.exp(wh) * self.anchors
+        scores = torch.sigmoid(scores)
 
-        detection[:, :, 2:4, :, :] = torch.exp(detection[:, :, 2:4, :, :]) * anchors
-        detection = detection.transpose(1, 2).contiguous().view(batch_size, self.num_classes+5, -1).transpose(1, 2)
+        detection = torch.cat((xy, wh, scores), dim=2)
+        # to [batch, anchors * grid * grid, box attributes] with a single copy
+        detection = detection.permute(0, 1, 3, 4, 2).reshape(batch_size, self.num_anchors * grid_h * grid_w, self.num_classes + 5)
 
         return detection
 
@@ -99,12 +120,14 @@ def create_modules(blocks):
     in_channel = 3
     out_channel = in_channel
     out_channels = []   # keep track of output channel for every block for specifying conv layer input channels
+    out_size = (int(net_info['height']), int(net_info['width']))
+    out_sizes = []      # keep track of output feature map [height, width] for every block for specifying yolo layer grid size
 
     for i, block in enumerate(blocks[1:]):
         block_type = block['type']
         if block_type == 'convolutional':
             module = nn.Sequential()
-            if 'batch_normalize' in block.keys():
+            if 'batch_normalize' in block:
                 bn = True
                 bias = False
             else:
@@ -130,6 +153,7 @@ def create_modules(blocks):
                 module.add_module('leaky_%d' % i, nn.LeakyReLU(0.1, inplace=True))
 
             out_channel = filters
+            out_size = tuple((size + 2 * padding - kernel_size) // stride + 1 for size in out_size)
 
         elif block_type == 'shortcut':
             idx = int(block['from']) + i
@@ -137,7 +161,8 @@ def create_modules(blocks):
 
         elif block_type == 'upsample':
             stride = int(block['stride'])
-            module = nn.Upsample(scale_factor=stride, mode='bilinear')
+            module = nn.Upsample(scale_factor=stride, mode='nearest')   # darknet upsamples by nearest neighbor
+            out_size = tuple(size * stride for size in out_size)
 
         # route block could have one or two indices. Negative value means relative index.
         elif block_type == 'route':
@@ -150,9 +175,11 @@ def create_modules(blocks):
                 if second_idx < 0:
                     second_idx += i
                 out_channel = out_channels[first_idx] + out_channels[second_idx]
+                out_size = out_sizes[first_idx]
                 module = RouteLayer([first_idx, second_idx])
             else:
                 out_channel = out_channels[first_idx]
+                out_size = out_sizes[first_idx]
                 module = RouteLayer([first_idx])
 
 
@@ -163,9 +190,10 @@ def create_modules(blocks):
             anchors = [[int(anchors[2*i]), int(anchors[2*i+1])] for i in masks]
             num_classes = int(block['classes'])
             input_dim = int(net_info['width'])
-            module = DetectionLayer(anchors, num_classes, input_dim)
+            module = DetectionLayer(anchors, num_classes, input_dim, out_size)
 
         out_channels.append(out_channel)
+        out_sizes.append(out_size)
         in_channel = out_channel
         module_list.append(module)
 
@@ -176,29 +204,48 @@ class Darknet(nn.Module):
         super(Darknet, self).__init__()
         self.blocks = parse_cfg(cfg)
         self.net_info, self.module_list = create_modules(self.blocks)
-
+        # resolve block types to ints once so forward does not look up and compare strings per layer
+        self._ops = [(BLOCK_KINDS[block['type']], module) for block, module in zip(self.blocks[1:], self.module_list)]
+        # outputs that shortcut and route layers read later. Only these are kept during forward
+        self._referenced_outputs = set()
+        for module in self.module_list:
+            if isinstance(module, ShortcutLayer):
+                self._referenced_outputs.add(module.idx)
+            elif isinstance(module, RouteLayer):
+                self._referenced_outputs.update(module.indices)
+        # (index, has batch norm) of every conv block, for loading weights and fusing
+        self._conv_indices = [(i, 'batch_normalize' in block) for i, block in enumerate(self.blocks[1:]) if block['type'] == 'convolutional']
+        # NHWC layout lets cudnn/mkldnn pick tensor core and vectorized conv kernels
+        for kind, module in self._ops:
+            if kind == KIND_CONV:
+                module.to(memory_format=torch.channels_last)
+        # the model is only used for inference. Batch norm has to use running stats for fuse() to be valid
+        self.eval()
+
+    # no autograd bookkeeping is needed for detection
+    @torch.inference_mode()
     def forward(self, x, cuda):
-        blocks = self.blocks[1:]
-        outputs = []
-        detections = torch.tensor([], dtype=torch.float)
-        detections = Variable(detections)
-        if cuda:
-            detections = detections.cuda()
-        for i, module in enumerate(self.module_list):
-            block_type = blocks[i]['type']
-            if block_type == 'convolutional' or block_type == 'upsample':
-                x = module(x)
-            elif block_type == 'shortcut':
-                x = module(x, outputs)
-            elif block_type == 'route':
-                x = module(outputs)
-            elif block_type == 'yolo':
-                x = module(x, cuda)
-                detections = torch.cat((x, detections), dim=1)
-
-            outputs.append(x)
-
-        return detections
+        x = x.to(memory_format=torch.channels_last)
+        outputs = {}
+        detections = []
+        # run the backbone in half precision on GPU. Detection layers cast their input back to float
+        with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=x.is_cuda):
+            for i, (kind, module) in enumerate(self._ops):
+                if kind == KIND_CONV or kind == KIND_UPSAMPLE:
+                    x = module(x)
+                elif kind == KIND_SHORTCUT:
+                    x = x + outputs[module.idx]
+                elif kind == KIND_ROUTE:
+                    x = module(outputs)
+                elif kind == KIND_YOLO:
+                    x = module(x)
+                    detections.append(x)
+
+                if i in self._referenced_outputs:
+                    outputs[i] = x
+
+        # detections of later yolo layers come first
+        return torch.cat(detections[::-1], dim=1)
 
     '''
     Weights file structure:
@@ -206,46 +253,174 @@ class Darknet(nn.Module):
     - weights of conv layers 
         - conv layer with batch_norm: [bn_bias, bn_weight, bn_running_meanm, bn_running_var, conv_weight]
         - conv layer without batch_norm: [conv_bias, conv_weight]
+    The file holds raw numbers only and is read without unpickling anything
     '''
     def load_weights(self, file):
+        # fuse() folds batch norm into the convs, so the file layout no longer maps onto the modules
+        if any(has_bn and not hasattr(self.module_list[i], 'batchnorm_%d' % i) for i, has_bn in self._conv_indices):
+            raise RuntimeError('load_weights needs an unfused model, load the weights before calling fuse() or quantize()')
+
         with open(file, 'rb') as f:
             header = np.fromfile(f, np.int32, count=5)
-            weights = np.fromfile(f, np.float32)
+        # map the weights instead of reading them so pages are only touched once, when copied into the params.
+        # Copy-on-write mode keeps the array writable for torch.from_numpy without ever modifying the file
+        weights = np.memmap(file, dtype=np.float32, mode='c', offset=header.nbytes)
         self.header = torch.from_numpy(header)
         ptr = 0
 
-        for i in range(len(self.module_list)):
-            module = self.module_list[i]
-            block_type = self.blocks[i+1]['type']
-
-            if block_type == 'convolutional':
-                conv = module[0]
-                if 'batch_normalize' in self.blocks[i+1].keys():
-                    bn = module[1]
+        # for a model on GPU, stage each chunk in page-locked memory and copy it asynchronously on a side stream,
+        # so reading the next chunk from disk overlaps with the transfer of the previous one
+        stream = None
+        registered = []     # staging buffers to unregister, only those whose registration succeeded
+        turn = 0
+
+        def copy(dst, src):
+            nonlocal turn
+            if stream is None:
+                dst.copy_(src)
+                return
+            # the previous transfer out of this buffer has to finish before it is overwritten
+            if events[turn] is not None:
+                events[turn].synchronize()
+            staging = buffers[turn][:src.numel()].view(src.shape)
+            staging.copy_(src)
+            with torch.cuda.stream(stream):
+                dst.copy_(staging, non_blocking=True)
+                events[turn] = stream.record_event()
+            turn = 1 - turn
+
+        try:
+            if next(self.parameters()).is_cuda:
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                # two staging buffers sized for the largest tensor: one is filled while the other is transferred.
+                # They are plain host tensors registered with cuda rather than pin_memory allocations, so unregistering
+                # them at the end releases the page-locked memory instead of leaving it in torch's pinned host cache
+                size = max(getattr(self.module_list[i], 'conv_%d' % i).weight.numel() for i, _ in self._conv_indices)
+                buffers = [torch.empty(size, dtype=torch.float32) for _ in range(2)]
+                events = [None, None]
+                for buf in buffers:
+                    torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(buf.data_ptr(), buf.nbytes, 0))
+                    registered.append(buf)
+
+            for i, has_bn in self._conv_indices:
+                module = self.module_list[i]
+                conv = getattr(module, 'conv_%d' % i)
+                if has_bn:
+                    bn = getattr(module, 'batchnorm_%d' % i)
                     num_weights = bn.weight.numel()
 
-                    bn_bias = torch.from_numpy(weights[ptr: ptr + num_weights]).view_as(bn.bias.data)
-                    ptr += num_weights
-                    bn_weight = torch.from_numpy(weights[ptr: ptr + num_weights]).view_as(bn.weight.data)
-                    ptr += num_weights
-
-                    bn_running_mean = torch.from_numpy(weights[ptr: ptr + num_weights]).view_as(bn.running_mean)
-                    ptr += num_weights
-                    bn_running_var = torch.from_numpy(weights[ptr: ptr + num_weights]).view_as(bn.running_var)
-                    ptr += num_weights
+                    # bn parameters are stored back to back, so read them as one slice
+                    bn_params = torch.from_numpy(weights[ptr: ptr + 4 * num_weights])
+                    bn_bias, bn_weight, bn_running_mean, bn_running_var = torch.split(bn_params, num_weights)
+                    ptr += 4 * num_weights
 
-                    bn.weight.data.copy_(bn_weight)
-                    bn.bias.data.copy_(bn_bias)
-                    bn.running_mean.copy_(bn_running_mean)
-                    bn.running_var.copy_(bn_running_var)
+                    copy(bn.weight.data, bn_weight)
+                    copy(bn.bias.data, bn_bias)
+                    copy(bn.running_mean, bn_running_mean)
+                    copy(bn.running_var, bn_running_var)
                 else:
                     num_bias = conv.bias.numel()
-                    conv_bias = torch.from_numpy(weights[ptr: ptr + num_bias]).view_as(conv.bias.data)
+                    copy(conv.bias.data, torch.from_numpy(weights[ptr: ptr + num_bias]))
                     ptr += num_bias
-                    conv.bias.data.copy_(conv_bias)
 
+                # conv weights are channels_last, so the flat chunk is shaped like the weight rather than copied into a flat view of it
                 num_weights = conv.weight.numel()
-                conv_weight = torch.from_numpy(weights[ptr: ptr + num_weights]).view_as(conv.weight.data)
+                copy(conv.weight.data, torch.from_numpy(weights[ptr: ptr + num_weights]).view(conv.weight.shape))
                 ptr += num_weights
-                conv.weight.data.copy_(conv_weight)
-
+        finally:
+            if stream is not None:
+                stream.synchronize()
+            for buf in registered:
+                torch.cuda.check_error(torch.cuda.cudart().cudaHostUnregister(buf.data_ptr()))
+
+    # save/load the state dict in safetensors format, which is mapped straight into tensors without unpickling.
+    # A state dict saved after fuse() only loads into a fused model
+    def save_weights_safetensors(self, file):
+        from safetensors.torch import save_file
+        save_file({k: v.contiguous() for k, v in self.state_dict().items()}, file)
+
+    def load_weights_safetensors(self, file):
+        from safetensors.torch import load_file
+        device = next(self.parameters()).device
+        self.load_state_dict(load_file(file, device=str(device)))
+
+    # export to ONNX for deployment runtimes such as TensorRT. The graph is simplified with onnx-simplifier if installed.
+    # Detection layers are traced at the cfg grid size, so input_shape has to match the cfg height and width.
+    # Only the batch size stays dynamic in the exported graph
+    def export_onnx(self, path, input_shape):
+        cfg_size = (int(self.net_info['height']), int(self.net_info['width']))
+        if tuple(input_shape[2:]) != cfg_size:
+            raise ValueError('input_shape %s does not match the cfg input size %s' % (tuple(input_shape), cfg_size))
+        self.eval()
+        dummy = torch.randn(input_shape, device=next(self.parameters()).device)
+        torch.onnx.export(self, (dummy, False), path, opset_version=13, input_names=['input'], output_names=['detections'],
+                          dynamic_axes={'input': {0: 'batch'}, 'detections': {0: 'batch'}}, dynamo=False)
+
+        try:
+            import onnx
+            from onnxsim import simplify
+        except ImportError:
+            return path
+        model, ok = simplify(onnx.load(path))
+        if ok:
+            onnx.save(model, path)
+
+        return path
+
+    # fold batch norm into the preceding conv layer. Only valid for inference, call after load_weights.
+    # Leaves conv + leaky blocks, which torch.compile fuses into the conv epilogue
+    def fuse(self):
+        for i, has_bn in self._conv_indices:
+            module = self.module_list[i]
+            if not has_bn or not hasattr(module, 'batchnorm_%d' % i):
+                continue
+            conv = getattr(module, 'conv_%d' % i)
+            bn = getattr(module, 'batchnorm_%d' % i)
+
+            # created on the device and in the dtype of the original conv, so fusing works for any model.to(...)
+            fused = nn.Conv2d(in_channels=conv.in_channels, out_channels=conv.out_channels, kernel_size=conv.kernel_size,
+                              stride=conv.stride, padding=conv.padding, bias=True, device=conv.weight.device, dtype=conv.weight.dtype)
+            fused.to(memory_format=torch.channels_last)
+            with torch.no_grad():
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+                fused.bias.copy_(bn.bias - bn.running_mean * scale)
+
+            setattr(module, 'conv_%d' % i, fused)
+            delattr(module, 'batchnorm_%d' % i)
+
+        return self
+
+    # post-training static int8 quantization of the conv blocks for CPU inference. Detection layers stay in float.
+    # calib_batches is an iterable of input batches used to observe activation ranges
+    def quantize(self, calib_batches, backend='x86'):
+        self.fuse()
+        self.eval()
+        # sets the process-wide quantized engine, which the converted model needs at inference time as well
+        torch.backends.quantized.engine = backend
+        qconfig = get_default_qconfig(backend)
+
+        # quantize at the input of every conv block and dequantize at its output
+        for i, (kind, module) in enumerate(self._ops):
+            if kind != KIND_CONV:
+                continue
+            layers = [('quant_%d' % i, QuantStub())]
+            for name, layer in module.named_children():
+                # the quantized leaky relu does not support inplace
+                if isinstance(layer, nn.LeakyReLU):
+                    layer = nn.LeakyReLU(layer.negative_slope)
+                layers.append((name, layer))
+            layers.append(('dequant_%d' % i, DeQuantStub()))
+            module = nn.Sequential(OrderedDict(layers))
+            module.qconfig = qconfig
+            self.module_list[i] = module
+            self._ops[i] = (kind, module)
+
+        prepare(self, inplace=True)
+        with torch.no_grad():
+            for batch in calib_batches:
+                self(batch, False)
+        convert(self, inplace=True)
+
+        return self
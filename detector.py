@@ -28,6 +28,7 @@ def parse_args():
     parser.add_argument('-w', '--webcam', action='store_true',  default=False, help='flag for detecting from webcam. Specify webcam ID in the input. usually 0 for a single webcam connected')
     parser.add_argument('--cuda', action='store_true', default=False, help='flag for running on GPU')
     parser.add_argument('--no-show', action='store_true', default=False, help='do not show the detected video in real time')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the network with torch.compile')
 
     args = parser.parse_args()
 
@@ -169,9 +170,13 @@ def main():
 
     print('Loading network...')
     model = Darknet("cfg/yolov3.cfg")
-    model.load_weights('yolov3.weights')
+    # move to GPU first so weights stream straight into device memory
     if args.cuda:
         model.cuda()
+    model.load_weights('yolov3.weights')
+    model.fuse()
+    if args.compile:
+        model.compile()     # fuses each conv with its activation and the detection layer ops
 
     model.eval()
     print('Network loaded')